@@ -4,14 +4,57 @@ Creates a local fiftyone dataset from a COYO-Tiny dataset.
 import argparse
 import os
 import magic
+import random
+import struct
 import logging
 import fiftyone as fo
 import fiftyone.core.fields as fof
 
+from datetime import datetime
+from functools import partial
+from itertools import chain, islice
 from pathlib import Path
 from datasets import Dataset, load_from_disk
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
+
+from io_uring_stat import read_headers
+
+# A single libmagic handle reused for every sample, so the magic database is
+# loaded once per process rather than once per image.
+_MIME = magic.Magic(mime=True)
+
+# Used for the samples' `_rand` field without touching the global random state.
+# Only drawn from in the main process: forked worker processes would inherit
+# the same state and repeat each other's values.
+_random = random.Random()
+
+# Optional per-image scores copied onto each sample when present.
+SCORE_FIELDS = (
+	'clip_similarity_vitb32',
+	'clip_similarity_vitl14',
+	'nsfw_score_gantman',
+	'nsfw_score_opennsfw2',
+	'aesthetic_score_laion_v2',
+	'num_faces'
+)
+
+# Start-of-Frame markers, whose segments hold a JPEG image's dimensions. (0xC4,
+# 0xC8 and 0xCC fall in the same range but are other segment types.)
+_JPEG_SOF_MARKERS = frozenset(
+	{0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+)
+
+# Number of bytes read from the start of each image for MIME detection. Most
+# images are identified from their first few bytes, but files in other formats
+# fall back to libmagic, which may need more.
+HEADER_BYTES = 8192
+
+# Number of image entries handed to a worker process at a time.
+SAMPLE_CHUNK_SIZE = 256
+
+# Number of samples created and added to the FiftyOne dataset at a time.
+ADD_SAMPLES_BATCH_SIZE = 10000
 
 def setup_logging():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -49,8 +92,27 @@ def create_coyo_fiftyone_dataset(name) -> fo.Dataset:
 	"""
 	dataset = fo.Dataset(name=name, persistent=True, overwrite=True)
 
+	# Samples are inserted as raw documents, so the media type that
+	# `add_samples()` would infer from the first sample is set here.
+	dataset.media_type = 'image'
+
 	dataset.add_sample_field('image_path', fof.StringField)
 
+	dataset.add_sample_field(
+		'caption',
+		fof.EmbeddedDocumentField,
+		embedded_doc_type=fo.DynamicEmbeddedDocument,
+		description='The caption of the image and its text statistics'
+	)
+
+	# The caption's attributes are declared here rather than discovered with
+	# `add_dynamic_sample_fields()`, which would scan every inserted sample.
+	dataset.add_sample_field('caption.caption', fof.StringField, description='The caption of the image')
+	dataset.add_sample_field('caption.text_length', fof.IntField, description='The number of characters in the caption')
+	dataset.add_sample_field('caption.word_count', fof.IntField, description='The number of words in the caption')
+	dataset.add_sample_field('caption.token_count_gpt', fof.IntField, description='The number of GPT tokens in the caption')
+	dataset.add_sample_field('caption.token_count_bert', fof.IntField, description='The number of BERT tokens in the caption')
+
 	dataset.add_sample_field(
 		'clip_similarity_vitb32', 
 		fof.FloatField, 
@@ -89,103 +151,224 @@ def create_coyo_fiftyone_dataset(name) -> fo.Dataset:
 	
 	return dataset
 
-def create_fo_sample(image_directory, image: dict) -> fo.Sample:
+def get_image_filepath(image_directory: str, image: dict) -> str:
+	"""
+	Returns the path of the downloaded file for a given image entry.
 	"""
-	Creates a FiftyOne Sample from a given image entry with metadata and custom fields.
+	return f"{image_directory}/{image['id']}.jpg"
+
+def sniff_mime(header: bytes) -> str:
+	"""
+	Returns the MIME type of a JPEG, PNG, GIF or WebP image from its leading bytes.
+
+	Nearly all COYO images are in one of these formats, so checking their
+	signatures avoids walking libmagic's database for most samples.
+
+	Args:
+		header (bytes): The first bytes of the file.
+
+	Returns:
+		str: The MIME type, or None if the signature is not recognized.
+	"""
+	if header.startswith(b'\xff\xd8\xff'):
+		return 'image/jpeg'
+	if header.startswith(b'\x89PNG\r\n\x1a\n'):
+		return 'image/png'
+	if header.startswith((b'GIF87a', b'GIF89a')):
+		return 'image/gif'
+	if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+		return 'image/webp'
+	return None
+
+def parse_jpeg_dims(header: bytes) -> tuple:
+	"""
+	Returns the dimensions of a JPEG image from its Start-of-Frame marker.
+
+	Walks the marker segments at the start of the file, so the image does not
+	need to be decoded.
+
+	Args:
+		header (bytes): The first bytes of the JPEG file.
+
+	Returns:
+		tuple: The (width, height) of the image, or None if no Start-of-Frame
+		marker was found within `header`.
+	"""
+	# Skip the Start-of-Image marker.
+	offset = 2
+	while offset + 9 <= len(header):
+		if header[offset] != 0xFF:
+			return None
+
+		marker = header[offset + 1]
+		if marker == 0xFF:
+			# Fill byte before a marker.
+			offset += 1
+		elif marker in _JPEG_SOF_MARKERS:
+			height, width = struct.unpack('>HH', header[offset + 5:offset + 9])
+			return width, height
+		elif marker == 0xDA:
+			# Start-of-Scan: entropy-coded data follows, there is no frame header.
+			return None
+		elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+			# Markers without a length field.
+			offset += 2
+		else:
+			segment_length, = struct.unpack('>H', header[offset + 2:offset + 4])
+			offset += 2 + segment_length
+
+	return None
+
+def _generate_rand() -> float:
+	"""
+	Returns a value for a sample's `_rand` field, in the same range FiftyOne uses.
+	"""
+	return _random.random() * 0.001 + 0.999
+
+def to_mongo_doc(image_directory: str, image: dict, file_info: tuple = None, filepath: str = None) -> dict:
+	"""
+	Creates the MongoDB document of a FiftyOne sample from a given image entry with metadata and custom fields.
+
+	The document has the same layout that `fo.Sample` would write for an image
+	sample, so it can be inserted directly without the per-field validation of
+	building a `fo.Sample`. Fields without a value are left out, as FiftyOne does.
 
 	Args:
 		image (dict): A dictionary containing image data including the path and other properties.
+		file_info (tuple, optional): The (size, header) of the image file as returned by
+			`read_headers`. The file is read here if not given.
+		filepath (str, optional): The path of the image file, if already known.
 
 	Returns:
-		fo.Sample: The FiftyOne Sample object with the image and its metadata.
+		dict: The sample document, without its `_dataset_id` and `_rand`.
 	"""
-	filepath = str(image_directory) + '/' + str(image['id']) + '.jpg'
+	if filepath is None:
+		filepath = get_image_filepath(image_directory, image)
 	
-	# Attempt to get image size, falling back to 0 if not found.
-	try:
-		image_size_bytes = os.path.getsize(filepath)
-	except FileNotFoundError:
-		image_size_bytes = 0
+	if file_info is None:
+		file_info = read_headers([filepath], HEADER_BYTES).get(filepath, (0, None))
 	
-	# Attempt to get MIME type, falling back to an empty string if not found.
+	# Get the MIME type from the header bytes, falling back to an empty string
+	# if the file was not found.
+	image_size_bytes, header = file_info
 	try:
-		mime_type = magic.from_file(filepath, mime=True)
+		mime_type = (sniff_mime(header) or _MIME.from_buffer(header)) if header else ''
 	except Exception:
 		mime_type = ''
 	
-	# Set the metadata for the sample.
-	metadata = fo.ImageMetadata(
-		height=image.get('height', None),
-		width=image.get('width', None),
-		size_bytes=image_size_bytes,
-		mime_type=mime_type
-	)
+	# Fall back to the dimensions in the JPEG header when the entry has none,
+	# so FiftyOne does not have to open the image to compute them later.
+	width = image.get('width')
+	height = image.get('height')
+	if height is None and mime_type == 'image/jpeg':
+		dims = parse_jpeg_dims(header)
+		if dims is not None:
+			width, height = dims
 	
-	caption = fo.DynamicEmbeddedDocument(
-		caption=image['text'],
-		text_length = image['text_length'],
-		word_count = image['word_count'],
-		token_count_gpt = image['num_tokens_gpt'],
-		token_count_bert = image['num_tokens_bert']
-	)
+	# Set the metadata for the sample.
+	metadata = {
+		'_cls': 'ImageMetadata',
+		'height': height,
+		'width': width,
+		'size_bytes': image_size_bytes,
+		'mime_type': mime_type
+	}
 	
-	if 'clip_similarity_vitb32' in image:
-		clip_similarity_vitb32 = image['clip_similarity_vitb32']
-	else:
-		clip_similarity_vitb32 = None
+	caption = {
+		'_cls': 'DynamicEmbeddedDocument',
+		'caption': image['text'],
+		'text_length': image['text_length'],
+		'word_count': image['word_count'],
+		'token_count_gpt': image['num_tokens_gpt'],
+		'token_count_bert': image['num_tokens_bert']
+	}
 	
-	if 'clip_similarity_vitl14' in image:
-		clip_similarity_vitl14 = image['clip_similarity_vitl14']
-	else:
-		clip_similarity_vitl14 = None
-		
-	if 'nsfw_score_gantman' in image:
-		nsfw_score_gantman = image['nsfw_score_gantman']
-	else:
-		nsfw_score_gantman = None
-
-	if 'nsfw_score_opennsfw2' in image:
-		nsfw_score_opennsfw2 = image['nsfw_score_gantman']
-	else:
-		nsfw_score_opennsfw2 = None
-
-	if 'aesthetic_score_laion_v2' in image:
-		aesthetic_score_laion_v2 = image['aesthetic_score_laion_v2']
-	else:
-		aesthetic_score_laion_v2 = None
-	
-	if 'num_faces' in image:
-		num_faces = image['num_faces']
-	else:
-		num_faces = None
-
-	sample = fo.Sample(
-		filepath=filepath,
-		metadata=metadata,
-		caption=caption,
-		clip_similarity_vitb32=clip_similarity_vitb32,
-		clip_similarity_vitl14=clip_similarity_vitl14,
-		nsfw_score_gantman=nsfw_score_gantman,
-		nsfw_score_opennsfw2=nsfw_score_opennsfw2,
-		aesthetic_score_laion_v2=aesthetic_score_laion_v2,
-		num_faces=num_faces	
-	)
+	now = datetime.utcnow()
+
+	doc = {
+		'filepath': filepath,
+		'tags': [],
+		'metadata': {k: v for k, v in metadata.items() if v is not None},
+		'caption': {k: v for k, v in caption.items() if v is not None},
+		'_media_type': 'image',
+		'created_at': now,
+		'last_modified_at': now
+	}
+
+	for field in SCORE_FIELDS:
+		value = image.get(field)
+		if value is not None:
+			doc[field] = value
+
+	return doc
+
+def to_mongo_docs(image_directory: str, images: list) -> list:
+	"""
+	Creates FiftyOne sample documents for a batch of image entries.
+
+	The sizes and headers of all the batch's image files are read together, so
+	the file I/O can be submitted in bulk rather than one file at a time.
 
-	return sample
+	Args:
+		images (list): A list of image entries as accepted by `to_mongo_doc`.
+
+	Returns:
+		list: The sample documents, in the same order as `images`.
+	"""
+	filepaths = [get_image_filepath(image_directory, image) for image in images]
+	file_info = read_headers(filepaths, HEADER_BYTES)
+
+	return [
+		to_mongo_doc(image_directory, image, file_info.get(filepath, (0, None)), filepath)
+		for image, filepath in zip(images, filepaths)
+	]
+
+def chunked(iterable, size: int):
+	"""
+	Yields successive lists of up to `size` items from an iterable.
+	"""
+	iterator = iter(iterable)
+	while chunk := list(islice(iterator, size)):
+		yield chunk
+
+def iter_image_batches(hf_dataset: Dataset, batch_size: int):
+	"""
+	Yields successive lists of up to `batch_size` image entries from a Hugging Face dataset.
+
+	Each batch is sliced out of the underlying Arrow table and converted to
+	dicts in one call, rather than decoding the dataset one row at a time.
+
+	Args:
+		hf_dataset (Dataset): The dataset to iterate over.
+		batch_size (int): The maximum number of entries per batch.
+	"""
+	arrow_dataset = hf_dataset.with_format('arrow')
+	for start in range(0, len(arrow_dataset), batch_size):
+		yield arrow_dataset[start:start + batch_size].to_pylist()
 
 def add_samples_to_fiftyone_dataset(
 	dataset: fo.Dataset,
-	samples: list
+	docs: list
 	):
 	"""
-	Creates a FiftyOne dataset from a list of samples.
+	Inserts a batch of sample documents into a FiftyOne dataset.
+
+	The documents are written straight to the dataset's sample collection,
+	skipping `fo.Sample` construction and validation. Every field they contain
+	is declared by `create_coyo_fiftyone_dataset`, so no schema needs to be
+	inferred. The `_rand` values are drawn here, in the main process, so they
+	are not repeated across the worker processes that built the documents.
+	Call `dataset.reload()` once all batches have been added.
 
 	Args:
-		samples (list): _description_
-		dataset_name (str): _description_
+		dataset (fo.Dataset): The dataset to add the samples to.
+		docs (list): The sample documents, as returned by `to_mongo_doc`.
 	"""
-	dataset.add_samples(samples, dynamic=True)
-	dataset.add_dynamic_sample_fields()
+	for doc in docs:
+		doc['_dataset_id'] = dataset._doc.id
+		doc['_rand'] = _generate_rand()
+
+	dataset._sample_collection.insert_many(docs, ordered=False, bypass_document_validation=True)
   
 def main():
 	"""
@@ -200,11 +383,22 @@ def main():
 	logging.info('Loading dataset from disk...')
 	hf_dataset = load_from_disk(args.dataset_path)
 
-	logging.info('Creating FiftyOne samples...')
-	samples = [create_fo_sample(args.image_directory, image) for image in hf_dataset]
+	# FiftyOne stores absolute filepaths.
+	image_directory = os.path.abspath(os.path.expanduser(args.image_directory))
+
+	logging.info('Creating FiftyOne samples and adding them to FiftyOne ...')
+	# Samples are built in worker processes so the per-image file I/O and
+	# document construction are not serialized by the GIL. They are created and
+	# added one batch at a time so only a single batch is held in memory.
+	with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+		for images in iter_image_batches(hf_dataset, ADD_SAMPLES_BATCH_SIZE):
+			docs = list(chain.from_iterable(executor.map(
+				partial(to_mongo_docs, image_directory),
+				chunked(images, SAMPLE_CHUNK_SIZE)
+			)))
+			add_samples_to_fiftyone_dataset(dataset, docs)
 
-	logging.info('Adding samples to FiftyOne ...')
-	add_samples_to_fiftyone_dataset(dataset, samples)
+	dataset.reload()
 
 	logging.info('Dataset creation completed.')
 
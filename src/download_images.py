@@ -1,14 +1,50 @@
-import os
-import shutil
+import atexit
+import asyncio
 import logging
 import argparse
-import requests
+import queue
+import aiofiles
+import aiofiles.os
+import aiohttp
+import numpy as np
 
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from datasets import Dataset, load_from_disk
 
 from tqdm.auto import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Maximum number of image downloads in flight at once.
+MAX_CONCURRENT_DOWNLOADS = 512
+
+# Maximum number of rows waiting to be picked up by a download worker.
+QUEUE_SIZE = 2048
+
+# Maximum number of open connections to any single host. Connections are kept
+# in the session's pool and reused, so a popular CDN host can serve many
+# downloads without new TCP and TLS handshakes.
+MAX_CONNECTIONS_PER_HOST = 64
+
+# Number of times a download is retried after a connection error or timeout.
+MAX_RETRIES = 2
+
+# Base delay in seconds between retries, doubled after each attempt.
+RETRY_BACKOFF_FACTOR = 0.3
+
+# Seconds to cache resolved host addresses, so many URLs on the same CDN host
+# share one DNS lookup.
+DNS_CACHE_TTL = 300
+
+# Seconds to keep idle connections open for reuse, so later requests to the
+# same host skip the TCP and TLS handshakes.
+KEEPALIVE_TIMEOUT = 30
+
+# Responses declaring a larger Content-Length are skipped without being read.
+MAX_IMAGE_BYTES = 20_000_000
+
+# Size of the chunks in which response bodies are written to disk. Large
+# chunks mean fewer Python-level iterations and larger write syscalls.
+CHUNK_SIZE = 1 << 20
 
 def parse_arguments():
     """
@@ -35,58 +71,155 @@ def parse_arguments():
     return args
 
 def setup_logging():
-    logging.basicConfig(filename='download_images.log', level=logging.INFO,
-                        format='%(asctime)s %(levelname)s:%(message)s')
+    """
+    Logs to download_images.log from a background thread.
 
+    Records are put on an in-memory queue and written to the file by a
+    QueueListener, so the event loop running the downloads never blocks on
+    file writes. The listener is flushed and stopped at exit.
+    """
+    file_handler = logging.FileHandler('download_images.log')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s:%(message)s'))
+
+    # The queue handler only renders the message; the file handler adds the
+    # timestamp and level when the record is written.
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
 
-def download_image(image_data:dict, image_directory:Path):
+
+async def download_image(session: aiohttp.ClientSession, image_data: dict, image_directory: Path):
     """
     Attempts to download an image from a URL and saves it to the specified directory.
     Skips the download on any error or if the content is not an image.
 
     Parameters:
+        session (aiohttp.ClientSession): The HTTP session shared by all downloads.
         image_data (dict): A dictionary containing the 'url' and 'id' of the image.
         image_directory (Path): The directory where the image will be saved.
     """
     url = image_data['url']
     image_id = image_data['id']
     file_path = image_directory / f"{image_id}.jpg"
+    # Bodies are written to a hidden temporary file and only renamed into place once complete,
+    # so a download cut off by a timeout or a dropped connection never looks like an image.
+    part_path = image_directory / f".{image_id}.jpg.part"
 
-    try:
-        response = requests.get(url, stream=True, timeout=5)
-        content_type = response.headers.get('Content-Type', '').lower()
-
-        if 'image' in content_type:
-            if response.status_code == 200:
-                with open(file_path, 'wb') as f:
-                    shutil.copyfileobj(response.raw, f)
-                return f"Downloaded {image_id}"
-            else:
-                return f"Failed {image_id}: Status code {response.status_code}"
-        else:
-            return f"Skipped {image_id}: Content is not an image"
-    except Exception as e:
-        return f"Skipped {image_id} due to error: {e}"
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with session.get(url) as response:
+                content_type = response.headers.get('Content-Type', '').lower()
+
+                # Drop the connection without reading the body for anything
+                # that is not an image or is too large to be one.
+                if 'image' not in content_type:
+                    response.close()
+                    return f"Skipped {image_id}: Content is not an image"
+                if (response.content_length or 0) > MAX_IMAGE_BYTES:
+                    response.close()
+                    return f"Skipped {image_id}: Content is larger than {MAX_IMAGE_BYTES:,} bytes"
+
+                if response.status == 200:
+                    try:
+                        async with aiofiles.open(part_path, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                                await f.write(chunk)
+                        await aiofiles.os.replace(part_path, file_path)
+                    except BaseException:
+                        try:
+                            await aiofiles.os.remove(part_path)
+                        except FileNotFoundError:
+                            pass
+                        raise
+                    return f"Downloaded {image_id}"
+                else:
+                    return f"Failed {image_id}: Status code {response.status}"
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            # Retry dropped connections and timeouts with an exponential backoff.
+            if attempt == MAX_RETRIES:
+                return f"Skipped {image_id} due to error: {e}"
+            await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt)
+        except Exception as e:
+            return f"Skipped {image_id} due to error: {e}"
+
+async def _download_worker(session: aiohttp.ClientSession, queue: asyncio.Queue, image_directory: Path, pbar: tqdm):
+    """
+    Downloads images taken from a queue until it receives a None sentinel.
+
+    Parameters:
+        session (aiohttp.ClientSession): The HTTP session shared by all downloads.
+        queue (asyncio.Queue): The queue of image data dictionaries to download.
+        image_directory (Path): The directory where images will be saved.
+        pbar (tqdm): The progress bar to update after each download.
+    """
+    while True:
+        image_data = await queue.get()
+        if image_data is None:
+            return
+
+        message = await download_image(session, image_data, image_directory)
+        pbar.update(1)
+        logging.info(message)
+
+async def _download_images(dataset: Dataset, image_directory: Path):
+    """
+    Downloads all images in the dataset concurrently on a single event loop.
+
+    A fixed pool of workers drains a bounded queue that is fed from the dataset,
+    so only a bounded number of rows and coroutines exist at any time.
+
+    Parameters:
+        dataset (Dataset): The dataset from which to download images.
+        image_directory (Path): The directory where images will be saved.
+    """
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENT_DOWNLOADS,
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT
+    )
+    timeout = aiohttp.ClientTimeout(total=10)
+
+    # Images are already compressed, so ask for them as-is and write the raw
+    # response bytes without passing them through a decompressor.
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers={'Accept-Encoding': 'identity'},
+        auto_decompress=False
+    ) as session:
+        with tqdm(total=len(dataset), desc="Downloading images") as pbar:
+            workers = [
+                asyncio.create_task(_download_worker(session, queue, image_directory, pbar))
+                for _ in range(MAX_CONCURRENT_DOWNLOADS)
+            ]
+
+            for image_data in dataset:
+                await queue.put(image_data)
+            for _ in workers:
+                await queue.put(None)
+
+            await asyncio.gather(*workers)
 
 def download_images(dataset:Dataset, image_directory:Path):
     """
-    Downloads all images in the dataset using multiple threads.
+    Downloads all images in the dataset.
+
+    Downloads are network-bound, so they are multiplexed over one asyncio event
+    loop, which can keep far more requests in flight than a pool of threads.
 
     Parameters:
         dataset (Dataset): The dataset from which to download images.
         image_directory (Path): The directory where images will be saved.
     """
-    num_workers = os.cpu_count()
     image_directory.mkdir(parents=True, exist_ok=True)
-    
-    with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        futures = [executor.submit(download_image, image_data, image_directory) for image_data in dataset]
-        
-        with tqdm(total=len(futures), desc="Downloading images") as pbar:
-            for future in as_completed(futures):
-                message = future.result()
-                pbar.update(1)
-                logging.info(message)
+    asyncio.run(_download_images(dataset, image_directory))
 
 
 
@@ -111,8 +244,11 @@ def main():
         else:
             print("Invalid choice. Exiting.")
             
-        # Shuffle the dataset and select a subset
-        loaded_subset = loaded_subset.shuffle(seed=42).select(range(subset_size))
+        # Select a random subset, sampling its row indices directly rather than shuffling the
+        # whole dataset, and sorting them so the rows are read from the Arrow files in order
+        indices = np.random.default_rng(42).choice(dataset_size, size=subset_size, replace=False)
+        indices.sort()
+        loaded_subset = loaded_subset.select(indices)
         print(f"Proceeding to download {subset_size:,} images.")
     elif user_confirmation == 'yes':
         subset_size = dataset_size
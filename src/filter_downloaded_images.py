@@ -1,10 +1,14 @@
 import argparse
 import os
+import numpy as np
+import pyarrow as pa
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datasets import Dataset, load_from_disk
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
-from typing import Union, List
+
+# Target size of each Arrow file the filtered dataset is saved as.
+MAX_SHARD_SIZE = '500MB'
 
 # Configure logging
 def setup_logging():
@@ -35,70 +39,201 @@ def parse_arguments():
     
     return args
 
-def get_image_paths(images_dir: Path) -> dict:
+def _parse_image_names(directory: str, names: np.ndarray) -> tuple:
+    """
+    Parses the image IDs (assumed to be the file stems) out of file names with vectorized NumPy
+    string operations, and joins the names into paths. Names whose stem is not an integer, such
+    as hidden files, are skipped.
+
+    Parameters:
+        directory (str): The directory containing the files.
+        names (np.ndarray): The file names (str).
+
+    Returns:
+        tuple: A tuple of two arrays: the image IDs (int64), and the full paths (str) to the
+        images in the same, unsorted, order.
+    """
+
+    if names.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.str_)
+
+    stems = np.char.partition(names, '.')[:, 0]
+    is_image = np.char.isdigit(stems)
+    return stems[is_image].astype(np.int64), np.char.add(directory + os.sep, names[is_image])
+
+def _scan_shard(directory: str) -> tuple:
+    """
+    Lists one shard of the image directory and parses its image IDs and paths. Runs in a
+    worker process.
+    """
+    return _parse_image_names(directory, np.array(os.listdir(directory), dtype=np.str_))
+
+def _split_shards(images_dir: str, names: np.ndarray) -> tuple:
     """
-    Retrieves the paths of all image files within a specified directory.
+    Separates the subdirectories of the image directory from its files.
 
-    This function iterates over all files in the given directory, filtering out non-file entries,
-    and constructs a dictionary mapping from image ID (assumed to be the file stem) to the full path of the image.
+    Image files always have an extension, so only the few names without one are checked with
+    a stat call.
+
+    Parameters:
+        images_dir (str): The directory containing image files.
+        names (np.ndarray): The names (str) of the entries in the directory.
+
+    Returns:
+        tuple: The names of the files (np.ndarray), and the paths of the subdirectories (list).
+    """
+
+    is_shard = np.zeros(names.shape, dtype=bool)
+    no_extension = np.flatnonzero(np.char.find(names, '.') < 0)
+    is_shard[no_extension] = [os.path.isdir(os.path.join(images_dir, name)) for name in names[no_extension]]
+    return names[~is_shard], [os.path.join(images_dir, name) for name in names[is_shard]]
+
+def _collect_image_paths(images_dir: str, names: np.ndarray, shards: list) -> tuple:
+    """
+    Parses the image files at the top of the image directory together with those of its shards,
+    and sorts them all by ID. The shards are scanned in parallel in separate processes, since
+    building the Python objects for each directory entry holds the GIL.
+
+    Returns:
+        tuple: The image IDs and paths, as returned by `get_image_paths`.
+    """
+
+    parts = [_parse_image_names(images_dir, names)]
+    if shards:
+        with ProcessPoolExecutor(max_workers=min(len(shards), os.cpu_count())) as executor:
+            parts.extend(executor.map(_scan_shard, shards))
+
+    ids = np.concatenate([part[0] for part in parts])
+    paths = np.concatenate([part[1] for part in parts])
+    order = np.argsort(ids)
+    return ids[order], paths[order]
+
+def get_image_paths(images_dir: Path) -> tuple:
+    """
+    Retrieves the IDs and paths of all image files within a specified directory, and within its
+    subdirectories if the images are sharded across them (e.g. `images/00/`, `images/01/`, ...).
+
+    Each directory is listed with a single `os.listdir` call, and the image IDs (assumed to be the
+    file stems) are parsed and joined into paths with vectorized NumPy string operations, so no
+    Python object is built per file beyond its name. Entries whose stem is not an integer, such as
+    hidden files, are skipped.
 
     Parameters:
         images_dir (Path): The directory containing image files.
 
     Returns:
-        dict: A dictionary where keys are image IDs (int) and values are the full paths (Path objects) to the images.
+        tuple: A tuple of two arrays: the image IDs (int64) in ascending order, and the full paths
+        (str) to the images in the same order.
     """
 
-    image_paths = [f for f in images_dir.iterdir() if f.is_file()]
-    return {int(path.stem): path for path in image_paths}
+    images_dir = str(images_dir)
+    names, shards = _split_shards(images_dir, np.array(os.listdir(images_dir), dtype=np.str_))
+    return _collect_image_paths(images_dir, names, shards)
 
-def add_image_path(entry: dict, image_id_to_path: dict) -> bool:
+def _get_modification_stamp(directories) -> int:
+    """
+    Returns the latest modification time (in nanoseconds) of the given directories.
     """
-    Adds the path of an image to a dataset entry if it exists in the provided dictionary.
+    return max((os.stat(directory).st_mtime_ns for directory in directories), default=0)
 
-    Args:
-        entry (dict): the dataset entry to which the image path will be added.
-        image_id_to_path (dict): the dictionary mapping image IDs to their paths.
+def get_cached_image_paths(images_dir: Path) -> tuple:
+    """
+    Retrieves the IDs and paths of all image files within a directory, reusing the index saved
+    next to it when the directory has not changed since it was written.
+
+    The index is a few `.npy` files beside the directory, stamped with the latest modification
+    time the directory and its shards had before they were scanned. Adding or removing an image
+    or a shard changes one of those modification times, so a stale index is never reused and the
+    directory is scanned again instead. A valid index is memory-mapped rather than read, so a
+    rerun does not list the directory at all.
+
+    Parameters:
+        images_dir (Path): The directory containing image files.
 
     Returns:
-        bool: a boolean value whether the image path was added to the entry.
+        tuple: The image IDs and paths, as returned by `get_image_paths`. The paths are absolute.
     """
 
-    image_id = entry['id']
-    if image_id in image_id_to_path:
-        entry['image_path'] = str(image_id_to_path[image_id])
-        return True
-    return False
+    # The index stores full paths, so it must not depend on the directory the script is run from
+    images_dir = Path(os.path.abspath(images_dir))
+    ids_path = images_dir.parent / f".{images_dir.name}.ids.npy"
+    paths_path = images_dir.parent / f".{images_dir.name}.paths.npy"
+    shards_path = images_dir.parent / f".{images_dir.name}.shards.npy"
+
+    try:
+        stamp = _get_modification_stamp([images_dir, *np.load(shards_path)])
+        if os.stat(ids_path).st_mtime_ns == stamp:
+            return np.load(ids_path, mmap_mode='r'), np.load(paths_path, mmap_mode='r')
+    except FileNotFoundError:
+        pass
+
+    # Take the stamp before the scan, so an image added while scanning makes the index stale
+    dir_mtime_ns = os.stat(images_dir).st_mtime_ns
+    names, shards = _split_shards(str(images_dir), np.array(os.listdir(images_dir), dtype=np.str_))
+    stamp = max(dir_mtime_ns, _get_modification_stamp(shards))
+    sorted_ids, paths = _collect_image_paths(str(images_dir), names, shards)
 
-def parallel_filter_and_add_path(dataset, check_and_add_function, image_id_to_path, max_workers=10):
+    # Write to temporary files first so an interrupted run never leaves a partial index behind.
+    # The IDs are written last, and their stamp is what marks the index as valid.
+    # Failing to save the index only costs a rescan on the next run, so it is not an error.
+    index = ((paths_path, paths), (shards_path, np.array(shards, dtype=np.str_)), (ids_path, sorted_ids))
+    for index_path, array in index:
+        tmp_path = index_path.with_name(index_path.name + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.utime(tmp_path, ns=(stamp, stamp))
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            logging.warning(f"Could not save the image index at {index_path}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            break
+
+    return sorted_ids, paths
+
+def filter_and_add_path(dataset: Dataset, sorted_ids: np.ndarray, sorted_paths: np.ndarray) -> Dataset:
     """
-    Filters a dataset in parallel by applying a check-and-add function to each entry and collects entries for which the function returns True.
+    Filters a dataset to the entries whose image has been downloaded and adds the image path to each of them.
+
+    Works directly on the dataset's Arrow table, so no Python object is created per entry. Each
+    entry's image is looked up with a binary search over the sorted image IDs, which touches far
+    less memory than probing a hash table built from them.
 
     Args:
-        dataset (list): A list of dataset entries to be processed.
-        check_and_add_function (function): A function that takes two arguments (an entry from the dataset and the image_id_to_path dictionary) and returns True if the entry should be included in the filtered dataset, False otherwise.
-        image_id_to_path (dict): The dictionary mapping image IDs to their paths.
-        max_workers (int, optional): The maximum number of threads to use for processing.
+        dataset (Dataset): The dataset to be filtered.
+        sorted_ids (np.ndarray): The IDs (int64) of the downloaded images, in ascending order.
+        sorted_paths (np.ndarray): The paths to the downloaded images, in the same order as `sorted_ids`.
+
+    Returns:
+        Dataset: The entries with a downloaded image, sorted by ID, with an added 'image_path' column.
     """
-    
-    filtered_dataset_with_paths = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_entry = {executor.submit(check_and_add_function, entry, image_id_to_path): entry for entry in dataset}
-        
-        for future in as_completed(future_to_entry):
-            entry = future_to_entry[future]
-            if future.result():
-                filtered_dataset_with_paths.append(entry)
-                
-    return filtered_dataset_with_paths
 
-def cache_dataset(cache_dir: str, dataset: Union[Dataset, List[dict]], dataset_name: str):
+    # The Arrow format applies any indices mapping left by an earlier filter or shuffle
+    table = dataset.with_format('arrow')[:]
+    ids = table['id'].to_numpy()
+
+    # Position of each entry's ID among the image IDs, and whether the ID is actually there
+    pos = np.searchsorted(sorted_ids, ids)
+    if sorted_ids.size:
+        valid = sorted_ids[np.minimum(pos, sorted_ids.size - 1)] == ids
+    else:
+        valid = np.zeros(ids.shape, dtype=bool)
+
+    # Gather the kept rows and their paths with the same row indices, in one pass each. Ordering
+    # the rows by their position among the sorted image IDs stores them in ID order, so later
+    # lookups by ID can binary search the column.
+    keep = np.flatnonzero(valid)
+    keep = keep[np.argsort(pos[keep], kind='stable')]
+    path_column = pa.array(sorted_paths[pos[keep]], type=pa.string())
+    return Dataset(table.take(keep).append_column('image_path', path_column))
+
+def cache_dataset(cache_dir: str, dataset: Dataset, dataset_name: str):
     """
     Caches the dataset to disk.
 
     Args:
         cache_dir (str): The base directory where the dataset will be cached.
-        dataset (Union[Dataset, List[dict]]): The dataset to be cached, can be a list of dictionaries or a Dataset object.
+        dataset (Dataset): The dataset to be cached.
         dataset_name (str): The name of the dataset.
     """
     
@@ -109,13 +244,9 @@ def cache_dataset(cache_dir: str, dataset: Union[Dataset, List[dict]], dataset_n
         # Create the directory if it doesn't exist
         dir_path.mkdir(parents=True, exist_ok=True)
         
-        # Check if dataset needs to be converted to a Dataset object
-        if isinstance(dataset, list):
-            dataset = Dataset.from_list(dataset)
-        
         # Save the dataset to disk
         dataset_path = dir_path / dataset_name
-        dataset.save_to_disk(str(dataset_path))
+        dataset.save_to_disk(str(dataset_path), max_shard_size=MAX_SHARD_SIZE)
         
         logging.info(f"Dataset '{dataset_name}' cached successfully at {dataset_path}")
     except Exception as e:
@@ -124,20 +255,18 @@ def cache_dataset(cache_dir: str, dataset: Union[Dataset, List[dict]], dataset_n
 def main():
     setup_logging()
     args = parse_arguments()
-    max_workers = os.cpu_count()
 
     # Load the dataset
     dataset = load_from_disk(args.subset_path)
     
-    # Get the paths of all image files
-    image_id_to_path = get_image_paths(args.image_directory)
+    # Get the IDs and paths of all image files
+    sorted_ids, sorted_paths = get_cached_image_paths(args.image_directory)
     
     # Filter the dataset and add the image paths
-    filtered_dataset_with_paths = parallel_filter_and_add_path(
+    filtered_dataset_with_paths = filter_and_add_path(
         dataset, 
-        add_image_path, 
-        image_id_to_path,  # Pass the dictionary here
-        max_workers=max_workers
+        sorted_ids,
+        sorted_paths
     )
     # Cache the dataset to disk
     cache_dataset(args.cache_path, filtered_dataset_with_paths, args.dataset_name)
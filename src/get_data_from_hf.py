@@ -1,8 +1,15 @@
 import os
+import random
 import argparse
 
 from pathlib import Path
-from datasets import load_dataset
+from datasets import Dataset, load_dataset
+
+# Minimum number of rows each process should write when saving in parallel.
+ROWS_PER_SAVE_PROCESS = 500_000
+
+# Target size of each Arrow file the subset is saved as.
+MAX_SHARD_SIZE = "500MB"
 
 def parse_arguments():
     """
@@ -20,36 +27,80 @@ def parse_arguments():
                         help='Percentage of the dataset to keep after shuffling')
     parser.add_argument('--subset-name', type=str, default='coyo-tiny',
                         help='Name for the saved subset')
+    parser.add_argument('--num-rows', type=int, default=None,
+                        help="Number of rows in the dataset, if its card does not declare the train split's size")
     return parser.parse_args()
 
+def get_save_num_proc(num_rows: int) -> int:
+    """
+    Returns the number of processes to save a dataset of the given size with.
+
+    Sending Arrow shards to worker processes has a large fixed cost, which makes
+    a parallel save slower than a single-process one unless every worker has
+    plenty of rows to write.
+    """
+    return min(os.cpu_count(), max(1, num_rows // ROWS_PER_SAVE_PROCESS))
+
+def reservoir_sample(rows, sample_size: int, seed: int = 42) -> list:
+    """
+    Draws a uniform random sample of rows in a single pass over an iterable (Algorithm R).
+
+    Only the rows currently in the sample are kept in memory, so the iterable can be far
+    larger than memory.
+
+    Returns:
+        list: The sampled rows.
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for i, row in enumerate(rows):
+        if i < sample_size:
+            reservoir.append(row)
+        else:
+            j = rng.randint(0, i)
+            if j < sample_size:
+                reservoir[j] = row
+    return reservoir
+
 def main():
     """
-    Main function to download a dataset from Hugging Face, shuffle it, select a subset, and save the subset to disk.
+    Main function to stream a dataset from Hugging Face, sample a random subset of it, and save the subset to disk.
     """
     args = parse_arguments()
     
     # Ensure cache directory exists
     args.cache_dir.mkdir(parents=True, exist_ok=True)
     
-    print(f"Downloading and caching {args.dataset_name} to {args.cache_dir}")
-    # Load the dataset
+    # Stream the dataset so it is never written to disk in full
     dataset = load_dataset(
         args.dataset_name, 
         cache_dir=args.cache_dir,
-        split="train")
-    print("Dataset downloaded and cached")
+        split="train",
+        streaming=True)
+    # A stream has no length, so the subset is sized from the split metadata on the dataset card
+    dataset_size = args.num_rows
+    if dataset_size is None:
+        splits = dataset.info.splits
+        if not splits or "train" not in splits or not splits["train"].num_examples:
+            raise ValueError(
+                f"{args.dataset_name} does not declare the number of rows in its train split, "
+                "which is needed to size the subset. Pass it with --num-rows."
+            )
+        dataset_size = splits["train"].num_examples
     
-    # Shuffle and select a subset
-    print(" Shuffling and selecting a subset...")
-    subset_size = int(len(dataset) * (args.subset_percentage / 100))
-    subset = dataset.shuffle(seed=42).select(range(subset_size))
+    # Sample a subset uniformly in one pass over the stream
+    print(f"Streaming and sampling a subset of {args.dataset_name}...")
+    subset_size = int(dataset_size * (args.subset_percentage / 100))
+    # Build the subset with the stream's known schema instead of inferring one from every row
+    subset = Dataset.from_list(reservoir_sample(dataset, subset_size), features=dataset.features)
     
     # Save the subset to disk
     print(f"Saving subset to {args.cache_dir / args.subset_name}")
     subset_path = args.cache_dir / args.subset_name
     subset.save_to_disk(
         dataset_path = subset_path,
-        num_proc=os.cpu_count()
+        max_shard_size=MAX_SHARD_SIZE,
+        num_proc=get_save_num_proc(len(subset))
         )
 if __name__ == "__main__":
     main()
\ No newline at end of file